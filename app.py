@@ -1,13 +1,59 @@
 from flask import Flask, request, jsonify, g
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+import orjson # Schnellere JSON-Serialisierung als das json-Modul der Standardbibliothek
+import redis
 import yfinance as yf
 import requests 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os # WICHTIG: Für Umgebungsvariablen
-import psycopg2 # WICHTIG: Der PostgreSQL-Treiber
+import sys
 from psycopg2.extras import RealDictCursor # WICHTIG: Um Dicts statt Tupeln zu bekommen
+from psycopg2.extras import execute_values
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+from psycopg2.extensions import DECIMAL, connection, new_type, register_type
+import threading
+import time
+import logging
+import math
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 # --- Konfiguration ---
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    JSON-Provider für jsonify auf Basis von orjson.
+    Typen, die orjson nicht kennt (z.B. Decimal), behandelt Flask wie bisher.
+    date und datetime kodiert orjson selbst als ISO 8601 ("2026-01-02") statt
+    im HTTP-Datumsformat von Flask ("Fri, 02 Jan 2026 00:00:00 GMT").
+    """
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_SERIALIZE_NUMPY # Kurse aus yfinance/pandas sind numpy-Werte
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+class JsonLogFormatter(logging.Formatter):
+    """
+    Schreibt jede Log-Zeile als JSON-Objekt, damit die Log-Aggregation nicht parsen muss.
+    """
+    def format(self, record):
+        entry = {"time": self.formatTime(record), "level": record.levelname,
+                 "logger": record.name, "message": record.getMessage()}
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry).decode()
+
+# Einmalig konfiguriert; Meldungen werden dank %s-Formatierung nur gebaut, wenn das Level passt
+logger = logging.getLogger('testbroker')
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(JsonLogFormatter())
+logger.addHandler(_log_handler)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+logger.propagate = False
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app) 
 
 # Hole die Datenbank-URL aus den Umgebungsvariablen
@@ -15,64 +61,653 @@ DATABASE_URL = os.environ.get('DATABASE_URL')
 # NEU: Geheimer Schlüssel für den Cron Job (in Render-Umgebungsvariablen festlegen)
 CRON_SECRET = os.environ.get('CRON_SECRET')
 
+CRYPTO_SUFFIX = '-USD' # Krypto-Ticker bei Yahoo, z.B. BTC-USD
+
+# Indizes für /market_data (Anzeigename, Yahoo-Ticker); einmal beim Import angelegt
+MARKET_TICKERS = (
+    ("DAX", "^GDAXI"),
+    ("Nasdaq", "^IXIC"),
+    ("Dow Jones", "^DJI"),
+    ("Nikkei", "^N225"),
+    ("S&P 500", "^GSPC"),
+    ("Gold", "GC=F"),
+    ("Bitcoin", "BTC-USD"),
+)
+
+# NUMERIC-Spalten als float statt Decimal lesen: spart die Umwandlung vor jsonify und
+# erlaubt Rechnen mit den (float-)Kursen von Yahoo
+register_type(new_type(DECIMAL.values, 'DEC2FLOAT', lambda value, cursor: float(value) if value is not None else None))
+
+# NEU: Verbindungspool pro Prozess, damit nicht jede Anfrage einen neuen TCP/TLS-Handshake macht
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 2))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 20)) # Pro Worker-Prozess; Supabase-Verbindungslimit beachten
+# Heiße Statements einmal pro Verbindung mit PREPARE vorbereiten. Nur mit direkter Verbindung
+# oder PgBouncer im Session-Modus einschalten: im Transaction-Modus (Supabase-Pooler, Port 6543)
+# landet EXECUTE auf einer anderen Server-Verbindung als das PREPARE.
+DB_PREPARE = os.environ.get('DB_PREPARE') == '1'
+DB_POOL_TIMEOUT = 10 # Sekunden, die ein Request auf eine freie Verbindung wartet
+_DB_POOL = None
+_DB_POOL_LOCK = threading.Lock()
+# Begrenzt die ausgeliehenen Verbindungen auf DB_POOL_MAX. Unter gevent laufen pro Worker
+# bis zu WORKER_CONNECTIONS Requests gleichzeitig; statt PoolError warten sie hier (kooperativ).
+_DB_SLOTS = threading.BoundedSemaphore(DB_POOL_MAX)
+
+# NEU: In-Process-Cache für Kursdaten (Yahoo ist die langsamste Stelle der API)
+QUOTE_TTL = 30 # Sekunden, die ein Kurs wiederverwendet werden darf
+HISTORY_QUOTE_MAX_AGE = 300 # Für den stündlichen Cron Job reichen auch etwas ältere Kurse
+CACHE_MAXSIZE = 4096 # Einträge pro Cache; die ältesten fliegen zuerst raus
+_TICKER_CACHE = {} # ticker_symbol -> (zeitstempel, ticker_info)
+NAME_TTL = 24 * 60 * 60 # Firmennamen ändern sich praktisch nie
+_NAME_CACHE = {} # ticker_symbol -> (zeitstempel, name)
+UNKNOWN_TICKER_TTL = 600 # Ticker, die Yahoo nicht kennt, so lange ohne Netzwerkaufruf ablehnen
+_UNKNOWN_TICKERS = {} # ticker_symbol -> (zeitstempel, True)
+_CACHE_LOCK = threading.Lock()
+_INFLIGHT = {} # ticker_symbol -> Future des Threads, der den Kurs gerade lädt
+_INFLIGHT_LOCK = threading.Lock()
+
+# NEU: Threads für Yahoo-Abrufe, die parallel zu Datenbankabfragen laufen sollen
+_EXECUTOR = ThreadPoolExecutor(max_workers=8)
+
+# yfinance nutzt curl_cffi, dessen HTTP-Aufrufe in C laufen: gevent kann dort nicht umschalten,
+# ein einzelner Aufruf würde den ganzen Worker anhalten. Unter gevent (gepatchtes threading)
+# laufen die yfinance-Aufrufe deshalb auf echten OS-Threads; ohne gevent direkt.
+_YF_POOL = None
+try:
+    from gevent import monkey
+    if monkey.is_module_patched('threading'):
+        from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+        _YF_POOL = NativeThreadPoolExecutor(max_workers=8)
+except ImportError:
+    pass
+
+# NEU: Optionaler Hintergrund-Thread, der Kurse vorab lädt (Sekunden, 0 = aus).
+# Sollte kleiner als QUOTE_TTL sein, damit Requests praktisch nie auf Yahoo warten.
+# Mit Redis aktualisiert pro Intervall nur ein Worker (Sperre quote-refresh:lock), die anderen
+# lesen die Kurse aus Redis; ohne Redis aktualisiert jeder Worker selbst.
+QUOTE_REFRESH_INTERVAL = int(os.environ.get('QUOTE_REFRESH_INTERVAL', 0))
+
+# NEU: Fertige Antworten für Endpunkte, die für alle Nutzer gleich sind
+MARKET_DATA_TTL = 30
+SEARCH_TTL = 300
+HISTORY_TTL = 300 # Verlauf ändert sich nur mit dem stündlichen Cron Job (der den Cache leert).
+# Mit Redis liegt er nur dort (hist:<user_id>:<range>), damit das Leeren alle Worker erreicht;
+# ohne Redis im Prozess-Cache, dessen Leeren nur den Worker des Cron-Aufrufs trifft (Rest: bis HISTORY_TTL alt).
+PORTFOLIO_TTL = 5 # Nur mit Redis; kurz, da Kurse sich bewegen. /buy und /sell leeren den Eintrag sofort
+_RESPONSE_CACHE = {} # (endpunkt, schlüssel) -> (zeitstempel, antwortdaten)
+
+# NEU: Optionaler Redis-Cache, den sich alle Worker-Prozesse teilen (ohne REDIS_URL nur In-Process-Cache)
+REDIS_URL = os.environ.get('REDIS_URL')
+_REDIS = redis.Redis.from_url(REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5) if REDIS_URL else None
+
+# NEU: Gemeinsame HTTP-Session, damit TCP/TLS-Verbindungen zu Yahoo wiederverwendet werden
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=64,
+                                       max_retries=Retry(total=2, backoff_factor=0.1,
+                                                         # Kurzzeitige Gateway-Fehler wiederholen, 429 (Rate Limit) nicht
+                                                         status_forcelist=(502, 503, 504),
+                                                         raise_on_status=False)))
+_SESSION.headers['User-Agent'] = 'Mozilla/5.0' # Yahoo blockt Anfragen ohne Browser-User-Agent
+YAHOO_QUOTE_URL = "https://query1.finance.yahoo.com/v7/finance/quote"
+YAHOO_BATCH_SIZE = 20 # Yahoo akzeptiert max. ca. 20 Symbole pro Anfrage
+HTTP_TIMEOUT = 5 # Sekunden; ohne Timeout kann ein hängender Yahoo-Aufruf einen Worker blockieren
+PRICE_TIMEOUT = 5 # Sekunden, die /sell auf den parallel abgerufenen Kurs wartet (der yfinance-Fallback hat kein eigenes Limit)
+
 # --- 0. Hilfsfunktionen (Kurs holen & DB-Verbindung) ---
 
-def get_db():
+class _PreparingConnection(connection):
     """
-    Stellt eine Verbindung zur Supabase-Datenbank her.
+    Verbindung, die sich merkt, welche Statements auf ihr schon vorbereitet sind.
     """
-    if 'db' not in g:
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+def get_db_pool():
+    """
+    Liefert den Verbindungspool und legt ihn beim ersten Aufruf an.
+    """
+    global _DB_POOL
+    if _DB_POOL is None:
         if DATABASE_URL is None:
             raise ValueError("DATABASE_URL ist nicht in den Umgebungsvariablen gesetzt!")
-        
-        g.db = psycopg2.connect(DATABASE_URL)
+        with _DB_POOL_LOCK:
+            if _DB_POOL is None:
+                # Keepalives verhindern, dass der Pool tote Verbindungen hortet
+                # application_name macht die Verbindungen in pg_stat_activity erkennbar
+                _DB_POOL = ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL,
+                                                  keepalives=1, keepalives_idle=30,
+                                                  application_name='testbroker-api',
+                                                  connection_factory=_PreparingConnection)
+    return _DB_POOL
+
+def _getconn():
+    """
+    Leiht eine Verbindung aus dem Pool. Sind alle vergeben, wird bis zu
+    DB_POOL_TIMEOUT Sekunden gewartet, statt sofort abzubrechen.
+    """
+    if not _DB_SLOTS.acquire(timeout=DB_POOL_TIMEOUT):
+        raise PoolError("Keine freie Datenbankverbindung im Pool.")
+    try:
+        pool = get_db_pool()
+        db = pool.getconn()
+        if db.closed: # Von der Gegenseite geschlossene Verbindung verwerfen
+            pool.putconn(db, close=True)
+            db = pool.getconn()
+        return db
+    except Exception:
+        _DB_SLOTS.release()
+        raise
+
+def _putconn(db, close=False):
+    """
+    Gibt eine mit _getconn geliehene Verbindung zurück.
+    """
+    try:
+        get_db_pool().putconn(db, close=close)
+    finally:
+        _DB_SLOTS.release()
+
+def _set_read_only(db, read_only):
+    """
+    Schaltet eine Pool-Verbindung zwischen Lesemodus (autocommit, read only) und
+    Schreibmodus (Transaktion bis zum commit) um. Nur bei einem Wechsel, denn
+    set_session schickt dann ein SET an den Server.
+    """
+    if db.autocommit != read_only:
+        db.set_session(readonly=read_only, autocommit=read_only)
+
+def get_db():
+    """
+    Holt eine Verbindung zur Supabase-Datenbank aus dem Pool.
+    GET-Anfragen lesen im autocommit-Modus und sparen sich BEGIN und ROLLBACK.
+    """
+    if 'db' not in g:
+        # Erst in g ablegen: schlägt das SET fehl, gibt das Teardown Verbindung und Slot trotzdem zurück
+        g.db = _getconn()
+        _set_read_only(g.db, request.method in ('GET', 'HEAD'))
     return g.db
 
+def _execute_prepared(cursor, name, sql, params):
+    """
+    Führt ein heißes Statement aus; mit DB_PREPARE über PREPARE/EXECUTE,
+    sodass Postgres es pro Verbindung nur einmal parst und plant.
+    sql verwendet benannte Platzhalter, params ist ein Dict.
+    """
+    if not DB_PREPARE:
+        cursor.execute(sql, params)
+        return
+    db = cursor.connection
+    if name not in db.prepared:
+        server_sql = sql
+        for i, key in enumerate(params, 1):
+            server_sql = server_sql.replace(f"%({key})s", f"${i}")
+        cursor.execute(f"PREPARE {name} AS {server_sql}")
+        db.prepared.add(name)
+    cursor.execute(f"EXECUTE {name} ({', '.join(f'%({key})s' for key in params)})", params)
+
 @app.teardown_appcontext
 def close_connection(exception):
     """
-    Schließt die Datenbankverbindung.
+    Gibt die Datenbankverbindung an den Pool zurück.
+    """
+    _release_db()
+
+def _release_db():
+    """
+    Gibt die Verbindung des Requests vorzeitig an den Pool zurück, z.B. vor einem Yahoo-Abruf.
+    Offene Transaktionen werden dabei vom Pool zurückgerollt; get_db holt bei Bedarf eine neue.
     """
     db = g.pop('db', None)
     if db is not None:
-        db.close()
+        _putconn(db, close=bool(db.closed))
+
+def _cache_get(cache, key, ttl):
+    """
+    Liefert den gecachten Wert für key, falls er jünger als ttl Sekunden ist, sonst None.
+    """
+    with _CACHE_LOCK:
+        hit = cache.get(key)
+    if hit and time.monotonic() - hit[0] < ttl:
+        return hit[1]
+    return None
+
+def _cache_set(cache, key, value):
+    """
+    Legt einen Wert mit aktuellem Zeitstempel im Cache ab.
+    """
+    with _CACHE_LOCK:
+        cache.pop(key, None) # Neu einfügen, damit die Einfügereihenfolge dem Alter entspricht
+        cache[key] = (time.monotonic(), value)
+        while len(cache) > CACHE_MAXSIZE:
+            del cache[next(iter(cache))]
 
 def get_ticker_info(ticker_symbol):
     """
     Holt aktuelle Kursdaten, prozentuale Veränderung und Namen für einen Ticker.
+    Ergebnisse werden QUOTE_TTL Sekunden im Speicher gehalten.
     Gibt ein Dictionary zurück oder None bei Fehler.
     """
+    return _fetch_quotes([ticker_symbol]).get(ticker_symbol)
+
+def _parse_yahoo_quote(q):
+    """
+    Wandelt einen Eintrag des Yahoo-Quote-Endpunkts in das Format von get_ticker_info um.
+    """
+    price = q.get('regularMarketPrice')
+    if price is None:
+        return None
+
+    change_pct = q.get('regularMarketChangePercent')
+    if change_pct is not None:
+        change_pct = change_pct / 100 # Yahoo liefert Prozent
+    else:
+        prev_close = q.get('regularMarketPreviousClose')
+        change_pct = (price - prev_close) / prev_close if prev_close else 0
+
+    return {
+        "price": price,
+        "change_pct": change_pct,
+        "name": q.get('longName') or q.get('shortName') or q['symbol']
+    }
+
+def _fetch_yahoo_quote_chunk(chunk):
+    """
+    Eine Anfrage an den Yahoo-Quote-Endpunkt für bis zu YAHOO_BATCH_SIZE Ticker.
+    Gibt None zurück, wenn die Anfrage selbst fehlgeschlagen ist.
+    """
+    quotes = {}
+    try:
+        response = _SESSION.get(YAHOO_QUOTE_URL, params={"symbols": ",".join(chunk)}, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        for q in response.json()['quoteResponse']['result']:
+            info = _parse_yahoo_quote(q)
+            if info is not None:
+                quotes[q['symbol']] = info
+                # Namen merken, damit ein späterer yfinance-Fallback kein .info mehr braucht
+                _cache_set(_NAME_CACHE, q['symbol'], info['name'])
+    except Exception as e:
+        logger.warning("Fehler beim Sammelabruf der Kurse für %s: %s", chunk, e)
+        return None
+    return quotes
+
+def _fetch_yahoo_quotes(symbols):
+    """
+    Fragt den Yahoo-Quote-Endpunkt gebündelt (max. YAHOO_BATCH_SIZE Symbole pro Anfrage) ab.
+    Mehrere Pakete werden parallel gesendet.
+    Liefert die Ticker, zu denen Yahoo einen Kurs geschickt hat, und die Menge der
+    Ticker, deren Anfrage fehlgeschlagen ist (über die also nichts bekannt ist).
+    """
+    chunks = [symbols[i:i + YAHOO_BATCH_SIZE] for i in range(0, len(symbols), YAHOO_BATCH_SIZE)]
+    if len(chunks) <= 1:
+        results = [_fetch_yahoo_quote_chunk(chunk) for chunk in chunks]
+    else:
+        with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+            results = list(executor.map(_fetch_yahoo_quote_chunk, chunks))
+
+    quotes = {}
+    failed = set()
+    for chunk, chunk_quotes in zip(chunks, results):
+        if chunk_quotes is None:
+            failed.update(chunk)
+        else:
+            quotes.update(chunk_quotes)
+    return quotes, failed
+
+def _yf_call(fn, *args, **kwargs):
+    """
+    Führt einen blockierenden yfinance-Aufruf aus, unter gevent auf einem OS-Thread aus _YF_POOL.
+    Der aufrufende Greenlet wartet dabei kooperativ.
+    """
+    if _YF_POOL is None:
+        return fn(*args, **kwargs)
+    return _YF_POOL.submit(fn, *args, **kwargs).result()
+
+def _fetch_ticker_info(ticker_symbol, not_found=None):
+    """
+    Fallback über yfinance, falls der Quote-Endpunkt nichts liefert.
+    Kurs und Vortagesschluss kommen aus dem schlanken fast_info; das teure .info
+    wird nur für den Namen abgefragt, und der wird NAME_TTL lang gecacht.
+    Nur wenn yfinance ohne Fehler keine Kursdaten liefert, landet das Symbol in not_found;
+    bei Fehlern (Rate-Limit, Timeout) wird nur None zurückgegeben.
+    """
     try:
         ticker = yf.Ticker(ticker_symbol)
-        info = ticker.info
-        
-        current_price = info.get('currentPrice', info.get('regularMarketPrice'))
-        day_change_pct = info.get('regularMarketChangePercent', info.get('marketChangePercent', 0))
-        name = info.get('longName', info.get('shortName', ticker_symbol)) 
+        fast_info = ticker.fast_info # lädt erst beim Zugriff auf die Felder
+        current_price, prev_close = _yf_call(lambda: (fast_info.last_price, fast_info.previous_close))
 
-        if current_price is None:
-            hist = ticker.history(period="1d")
-            if not hist.empty:
+        if current_price is None or not prev_close:
+            # Ein einziger 2-Tage-Verlauf liefert beides: letzten Kurs und Vortagesschluss
+            hist = _yf_call(ticker.history, period="2d", auto_adjust=False)
+            if current_price is None:
+                if hist.empty:
+                    if not_found is not None:
+                        not_found.add(ticker_symbol)
+                    return None
                 current_price = hist['Close'].iloc[-1]
-            else:
-                 return None 
+            if not prev_close and len(hist) >= 2:
+                prev_close = hist['Close'].iloc[-2]
 
-        if day_change_pct == 0:
-             hist_2d = ticker.history(period="2d")
-             if len(hist_2d) >= 2:
-                 prev_close = hist_2d['Close'].iloc[-2]
-                 if prev_close != 0:
-                     day_change_pct = (current_price - prev_close) / prev_close
+        day_change_pct = (current_price - prev_close) / prev_close if prev_close else 0
 
         return {
             "price": current_price,
             "change_pct": day_change_pct,
-            "name": name
+            "name": _get_ticker_name(ticker)
         }
 
     except Exception as e:
-        print(f"Fehler beim Abrufen der Ticker-Info für {ticker_symbol}: {e}")
+        logger.warning("Fehler beim Abrufen der Ticker-Info für %s: %s", ticker_symbol, e)
+        return None
+
+def _get_ticker_name(ticker):
+    """
+    Liefert den Namen eines yfinance-Tickers aus dem Namens-Cache, aus Redis oder über .info.
+    Schlägt .info fehl, wird das Symbol angezeigt (und nicht gecacht).
+    """
+    name = _cache_get(_NAME_CACHE, ticker.ticker, NAME_TTL)
+    if name is not None:
+        return name
+    if _REDIS is not None:
+        # Namen ändern sich praktisch nie; über Redis teilen sich alle Worker das teure .info
+        try:
+            name = _REDIS.get(f"name:{ticker.ticker}")
+        except redis.RedisError as e:
+            logger.warning("Redis nicht erreichbar (Lesen): %s", e)
+        if name is not None:
+            name = name.decode()
+            _cache_set(_NAME_CACHE, ticker.ticker, name)
+            return name
+    try:
+        info = _yf_call(lambda: ticker.info)
+        name = info.get('longName', info.get('shortName', ticker.ticker))
+    except Exception as e:
+        logger.warning("Fehler beim Abrufen des Namens für %s: %s", ticker.ticker, e)
+        return ticker.ticker
+    _cache_set(_NAME_CACHE, ticker.ticker, name)
+    if _REDIS is not None:
+        try:
+            _REDIS.setex(f"name:{ticker.ticker}", NAME_TTL, name)
+        except redis.RedisError as e:
+            logger.warning("Redis nicht erreichbar (Schreiben): %s", e)
+    return name
+
+def _cache_clear(cache, endpoint):
+    """
+    Entfernt alle Einträge eines Endpunkts aus dem Antwort-Cache.
+    """
+    with _CACHE_LOCK:
+        for key in [key for key in cache if key[0] == endpoint]:
+            del cache[key]
+
+def _redis_get_quotes(symbols):
+    """
+    Liest Kurse, die ein anderer Worker schon abgerufen hat, aus Redis.
+    Ist Redis nicht konfiguriert oder nicht erreichbar, wird einfach nichts geliefert.
+    """
+    if _REDIS is None or not symbols:
+        return {}
+    try:
+        values = _REDIS.mget([f"yf:{symbol}" for symbol in symbols])
+    except redis.RedisError as e:
+        logger.warning("Redis nicht erreichbar (Lesen): %s", e)
+        return {}
+    return {symbol: orjson.loads(value) for symbol, value in zip(symbols, values) if value is not None}
+
+def _redis_set_quotes(quotes):
+    """
+    Legt frisch abgerufene Kurse für QUOTE_TTL Sekunden in Redis ab.
+    """
+    if _REDIS is None or not quotes:
+        return
+    try:
+        pipe = _REDIS.pipeline(transaction=False)
+        for symbol, info in quotes.items():
+            pipe.setex(f"yf:{symbol}", QUOTE_TTL, orjson.dumps(info, option=orjson.OPT_SERIALIZE_NUMPY))
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.warning("Redis nicht erreichbar (Schreiben): %s", e)
+
+def _fetch_quotes(symbols, max_age=QUOTE_TTL):
+    """
+    Holt Kursdaten für mehrere Ticker mit möglichst wenigen Yahoo-Anfragen.
+    Ticker mit einem höchstens max_age Sekunden alten Cache-Eintrag (im Prozess oder in Redis)
+    werden nicht erneut abgefragt. Ticker, die Yahoo kürzlich nicht kannte, werden ohne
+    Netzwerkaufruf mit None beantwortet. Lädt ein anderer Thread einen Ticker gerade,
+    wird auf dessen Ergebnis gewartet statt Yahoo ein zweites Mal zu fragen.
+    Gibt ein Dictionary ticker_symbol -> ticker_info (oder None) zurück.
+    """
+    quotes = {}
+    missing = []
+    for symbol in symbols:
+        cached = _cache_get(_TICKER_CACHE, symbol, max_age)
+        if cached is not None:
+            quotes[symbol] = cached
+        elif _cache_get(_UNKNOWN_TICKERS, symbol, UNKNOWN_TICKER_TTL):
+            quotes[symbol] = None
+        elif symbol not in missing:
+            missing.append(symbol)
+
+    shared = _redis_get_quotes(missing)
+    for symbol, info in shared.items():
+        _cache_set(_TICKER_CACHE, symbol, info)
+    quotes.update(shared)
+    missing = [symbol for symbol in missing if symbol not in shared]
+
+    # Jeder fehlende Ticker wird nur von einem Thread geladen, alle anderen warten auf dessen Future
+    owned = []
+    waiting = {}
+    with _INFLIGHT_LOCK:
+        for symbol in missing:
+            future = _INFLIGHT.get(symbol)
+            if future is None:
+                _INFLIGHT[symbol] = Future()
+                owned.append(symbol)
+            else:
+                waiting[symbol] = future
+
+    fetched = {}
+    try:
+        fetched = _fetch_uncached_quotes(owned)
+    finally:
+        # Auch bei Fehlern auflösen, sonst warten andere Threads ewig
+        with _INFLIGHT_LOCK:
+            for symbol in owned:
+                _INFLIGHT.pop(symbol).set_result(fetched.get(symbol))
+    quotes.update(fetched)
+
+    for symbol, future in waiting.items():
+        quotes[symbol] = future.result()
+
+    return quotes
+
+def _fetch_uncached_quotes(symbols):
+    """
+    Lädt Ticker ohne Cache-Treffer: gebündelt über den Quote-Endpunkt, fehlende über yfinance.
+    Legt die Ergebnisse in den Caches ab.
+    """
+    quotes, batch_failed = _fetch_yahoo_quotes(symbols)
+
+    # Fallback: Einzelabruf über yfinance für alles, was der Sammelabruf nicht geliefert hat.
+    # Die Abrufe warten nur auf das Netzwerk und laufen daher parallel.
+    fallback = [symbol for symbol in symbols if symbol not in quotes]
+    not_found = set()
+    if len(fallback) == 1:
+        quotes[fallback[0]] = _fetch_ticker_info(fallback[0], not_found)
+    elif fallback:
+        with ThreadPoolExecutor(max_workers=min(8, len(fallback))) as executor:
+            quotes.update(zip(fallback, executor.map(lambda symbol: _fetch_ticker_info(symbol, not_found), fallback)))
+
+    for symbol in symbols:
+        if quotes[symbol] is not None: # Fehler nicht cachen, damit der nächste Aufruf es erneut versucht
+            _cache_set(_TICKER_CACHE, symbol, quotes[symbol])
+        elif symbol not in batch_failed and symbol in not_found:
+            # Weder der Quote-Endpunkt noch yfinance kennen den Ticker: ungültig
+            _cache_set(_UNKNOWN_TICKERS, symbol, True)
+    _redis_set_quotes({symbol: quotes[symbol] for symbol in symbols if quotes[symbol] is not None})
+
+    return quotes
+
+def _history_cache_get(user_id, range):
+    """
+    Liefert einen gecachten Portfolio-Verlauf aus Redis bzw. ohne Redis aus dem Prozess-Cache.
+    """
+    if _REDIS is None:
+        return _cache_get(_RESPONSE_CACHE, ('history', user_id, range), HISTORY_TTL)
+    try:
+        cached = _REDIS.get(f"hist:{user_id}:{range}")
+    except redis.RedisError as e:
+        logger.warning("Redis nicht erreichbar (Lesen): %s", e)
+        return None
+    return orjson.loads(cached) if cached is not None else None
+
+def _history_cache_set(user_id, range, history_data):
+    """
+    Legt einen Portfolio-Verlauf HISTORY_TTL Sekunden im Cache ab.
+    """
+    if _REDIS is None:
+        _cache_set(_RESPONSE_CACHE, ('history', user_id, range), history_data)
+        return
+    try:
+        _REDIS.setex(f"hist:{user_id}:{range}", HISTORY_TTL, orjson.dumps(history_data))
+    except redis.RedisError as e:
+        logger.warning("Redis nicht erreichbar (Schreiben): %s", e)
+
+def _history_cache_clear():
+    """
+    Verwirft alle gecachten Verläufe, nachdem der Cron Job neue Datenpunkte geschrieben hat.
+    """
+    if _REDIS is None:
+        _cache_clear(_RESPONSE_CACHE, 'history')
+        return
+    try:
+        keys = list(_REDIS.scan_iter(match="hist:*", count=500))
+        if keys:
+            _REDIS.unlink(*keys)
+    except redis.RedisError as e:
+        logger.warning("Redis nicht erreichbar (Löschen): %s", e)
+
+def _portfolio_cache_get(user_id):
+    """
+    Liefert ein kürzlich berechnetes Portfolio aus Redis.
+    Ohne Redis wird nicht gecacht: ein Prozess-Cache ließe sich nach einem Trade
+    nur im eigenen Worker leeren, die anderen zeigten noch das alte Portfolio.
+    """
+    if _REDIS is None:
         return None
+    try:
+        cached = _REDIS.get(f"portfolio:{user_id}")
+    except redis.RedisError as e:
+        logger.warning("Redis nicht erreichbar (Lesen): %s", e)
+        return None
+    return orjson.loads(cached) if cached is not None else None
+
+def _portfolio_cache_set(user_id, portfolio):
+    """
+    Legt ein berechnetes Portfolio PORTFOLIO_TTL Sekunden in Redis ab.
+    """
+    if _REDIS is None:
+        return
+    try:
+        _REDIS.setex(f"portfolio:{user_id}", PORTFOLIO_TTL, orjson.dumps(portfolio, option=orjson.OPT_SERIALIZE_NUMPY))
+    except redis.RedisError as e:
+        logger.warning("Redis nicht erreichbar (Schreiben): %s", e)
+
+def _portfolio_cache_invalidate(user_id):
+    """
+    Verwirft das gecachte Portfolio nach einem Kauf oder Verkauf (für alle Worker).
+    """
+    if _REDIS is None:
+        return
+    try:
+        _REDIS.delete(f"portfolio:{user_id}")
+    except redis.RedisError as e:
+        logger.warning("Redis nicht erreichbar (Löschen): %s", e)
+
+def _store_ticker_prices(cursor, quotes):
+    """
+    Schreibt abgerufene Kurse in die Tabelle ticker_prices (ein Upsert für alle Ticker).
+    So kann /portfolio frische Kurse direkt aus der Datenbank lesen.
+    """
+    # Nach Symbol sortiert: Cron Job und Refresh-Thread sperren die Zeilen so in derselben
+    # Reihenfolge und können sich nicht gegenseitig verklemmen (Deadlock)
+    rows = sorted((symbol, info['price'], info['change_pct'], info['name']) for symbol, info in quotes.items() if info)
+    if rows:
+        execute_values(cursor, """
+            INSERT INTO ticker_prices (symbol, price, change_pct, name) VALUES %s
+            ON CONFLICT (symbol) DO UPDATE
+            SET price = EXCLUDED.price, change_pct = EXCLUDED.change_pct,
+                name = EXCLUDED.name, updated_at = NOW()
+        """, rows)
+
+def _acquire_refresh_lock():
+    """
+    Sorgt dafür, dass pro Intervall nur ein Worker Kurse vorab lädt.
+    Ohne Redis (oder wenn Redis nicht erreichbar ist) aktualisiert jeder Worker.
+    """
+    if _REDIS is None:
+        return True
+    try:
+        return bool(_REDIS.set("quote-refresh:lock", os.getpid(), nx=True, ex=QUOTE_REFRESH_INTERVAL))
+    except redis.RedisError as e:
+        logger.warning("Redis nicht erreichbar (Sperre): %s", e)
+        return True
+
+def _refresh_quote_cache():
+    """
+    Lädt die Kurse aller Marktindizes und aller gehaltenen Ticker gebündelt in die Caches
+    und in die Tabelle ticker_prices; fehlende Ticker wie bei Requests über yfinance.
+    """
+    if not _acquire_refresh_lock():
+        return
+    symbols = [ticker for _, ticker in MARKET_TICKERS]
+    db = _getconn()
+    try:
+        _set_read_only(db, True)
+        with db.cursor() as cursor:
+            cursor.execute("SELECT DISTINCT ticker_symbol FROM positions")
+            symbols += [row[0] for row in cursor.fetchall() if row[0] not in symbols]
+    finally:
+        _putconn(db, close=bool(db.closed))
+
+    # Ohne geliehene Verbindung abrufen; legt die Kurse auch in Prozess-Cache und Redis ab
+    quotes = _fetch_uncached_quotes(symbols)
+
+    db = _getconn()
+    try:
+        _set_read_only(db, False) # Verbindung kann zuvor von einer GET-Anfrage genutzt worden sein
+        with db.cursor() as cursor:
+            _store_ticker_prices(cursor, quotes)
+        db.commit()
+    finally:
+        _putconn(db, close=bool(db.closed))
+
+def _quote_refresh_loop():
+    """
+    Endlosschleife des Hintergrund-Threads; Fehler werden geloggt und beim nächsten Durchlauf erneut versucht.
+    """
+    while True:
+        try:
+            _refresh_quote_cache()
+        except Exception as e:
+            logger.warning("Fehler beim Aktualisieren des Kurs-Caches: %s", e)
+        time.sleep(QUOTE_REFRESH_INTERVAL)
+
+if QUOTE_REFRESH_INTERVAL > 0:
+    threading.Thread(target=_quote_refresh_loop, name="quote-refresh", daemon=True).start()
+
+def normalize_ticker(raw_ticker):
+    """
+    Bringt eine Ticker-Eingabe in die Yahoo-Schreibweise (z.B. " aapl" -> "AAPL").
+    Der String wird internalisiert, da er als Cache-Schlüssel wiederholt verglichen wird.
+    """
+    return sys.intern(raw_ticker.strip().upper())
+
+def _public_cached(response, max_age):
+    """
+    Erlaubt Browsern und CDNs, eine für alle Nutzer gleiche Antwort max_age Sekunden zu cachen.
+    """
+    response.headers['Cache-Control'] = f'public, max-age={max_age}'
+    return response
 
 # --- 1. Die API-Endpunkte (Bestehender Code) ---
 
@@ -80,121 +715,225 @@ def get_ticker_info(ticker_symbol):
 def index():
     return "Willkommen beim TestBroker API!"
 
+@app.route("/healthz")
+def health():
+    """
+    Liveness-Check für Render und Load Balancer: antwortet ohne Datenbank, Redis oder Yahoo.
+    """
+    return '', 204
+
+def _parse_trade(data):
+    """
+    Prüft den JSON-Body von /buy und /sell, bevor Datenbank oder Yahoo bemüht werden.
+    Liefert (user_id, ticker, quantity) oder None bei fehlenden bzw. ungültigen Angaben.
+    """
+    if not isinstance(data, dict):
+        return None
+    try:
+        user_id = data['user_id']
+        ticker = normalize_ticker(data['ticker'])
+        quantity = data['quantity']
+        if isinstance(quantity, bool): # true wäre sonst float(True) == 1.0
+            return None
+        quantity = float(quantity)
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return None
+    # Nur Text oder Ganzzahl als Nutzer-ID; Objekte, Listen und bool sonst erst in Postgres (500)
+    if not isinstance(user_id, (str, int)) or isinstance(user_id, bool):
+        return None
+    if not ticker or not math.isfinite(quantity):
+        return None
+    return user_id, ticker, quantity
+
 @app.route("/buy", methods=['POST'])
 def buy_stock():
-    data = request.get_json()
-    user_id = data['user_id']
-    ticker = data['ticker'].strip().upper() 
-    quantity = float(data['quantity'])
+    trade = _parse_trade(request.get_json(silent=True))
+    if trade is None: return jsonify({"error": "Ungültige Anfrage."}), 400
+    user_id, ticker, quantity = trade
     if quantity <= 0: return jsonify({"error": "Anzahl > 0"}), 400
-    
-    ticker_data = get_ticker_info(ticker) 
+
+    db = get_db()
+    with db.cursor(cursor_factory=RealDictCursor) as cursor:
+        # Günstige Vorprüfung, damit unbekannte Nutzer und leere Konten nicht auf Yahoo warten
+        _execute_prepared(cursor, "account_cash", "SELECT cash_balance FROM accounts WHERE user_id = %(user_id)s",
+                          {"user_id": user_id})
+        account = cursor.fetchone()
+        if account is None: return jsonify({"error": f"Nutzer {user_id} nicht gefunden."}), 404
+        if account['cash_balance'] <= 0: return jsonify({"error": "Nicht genügend Bargeld."}), 400
+
+    # Verbindung nicht über den Yahoo-Abruf halten, sonst leert langsames Yahoo den Pool
+    _release_db()
+    ticker_data = get_ticker_info(ticker)
     if ticker_data is None:
         return jsonify({"error": f"Kurs für Ticker {ticker} nicht gefunden."}), 404
     price = ticker_data['price']
 
     total_cost = price * quantity
+
     db = get_db()
-    
     with db.cursor(cursor_factory=RealDictCursor) as cursor:
-        cursor.execute("SELECT cash_balance FROM accounts WHERE user_id = %s", (user_id,))
-        account = cursor.fetchone()
-        
-        if account is None: return jsonify({"error": f"Nutzer {user_id} nicht gefunden."}), 404
-        if account['cash_balance'] < total_cost: return jsonify({"error": "Nicht genügend Bargeld."}), 400
-        
-        new_cash_balance = account['cash_balance'] - total_cost
-        cursor.execute("UPDATE accounts SET cash_balance = %s WHERE user_id = %s", (new_cash_balance, user_id))
-        
-        cursor.execute("SELECT * FROM positions WHERE user_id = %s AND ticker_symbol = %s", (user_id, ticker))
-        position = cursor.fetchone()
-        
-        if position:
-            old_quantity = position['quantity']
-            old_avg_price = position['average_buy_price']
-            new_quantity = old_quantity + quantity
-            new_avg_price = ((old_avg_price * old_quantity) + (price * quantity)) / new_quantity
-            cursor.execute("UPDATE positions SET quantity = %s, average_buy_price = %s WHERE position_id = %s", 
-                           (new_quantity, new_avg_price, position['position_id']))
-        else:
-            cursor.execute("INSERT INTO positions (user_id, ticker_symbol, quantity, average_buy_price) VALUES (%s, %s, %s, %s)", 
-                           (user_id, ticker, quantity, price))
-        
-        cursor.execute("INSERT INTO transactions (user_id, ticker_symbol, transaction_type, quantity, price_per_share) VALUES (%s, %s, 'BUY', %s, %s)", 
-                       (user_id, ticker, quantity, price))
+        # Bargeld abbuchen, Position anlegen/aufstocken und Transaktion loggen in einem Round-Trip.
+        # Die Buchung greift nur, wenn genug Bargeld da ist; sonst schreibt keine der Stufen etwas.
+        _execute_prepared(cursor, "buy_book", """
+            WITH debited AS (
+                UPDATE accounts SET cash_balance = cash_balance - %(cost)s
+                WHERE user_id = %(user_id)s AND cash_balance >= %(cost)s
+                RETURNING user_id
+            ), upserted AS (
+                INSERT INTO positions (user_id, ticker_symbol, quantity, average_buy_price)
+                SELECT user_id, %(ticker)s::text, %(quantity)s::numeric, %(price)s::numeric FROM debited
+                ON CONFLICT (user_id, ticker_symbol) DO UPDATE
+                SET average_buy_price = (positions.average_buy_price * positions.quantity
+                                         + EXCLUDED.average_buy_price * EXCLUDED.quantity)
+                                        / (positions.quantity + EXCLUDED.quantity),
+                    quantity = positions.quantity + EXCLUDED.quantity
+                RETURNING user_id
+            )
+            INSERT INTO transactions (user_id, ticker_symbol, transaction_type, quantity, price_per_share)
+            SELECT user_id, %(ticker)s::text, 'BUY', %(quantity)s::numeric, %(price)s::numeric FROM upserted
+        """, {"user_id": user_id, "ticker": ticker, "quantity": quantity, "price": price, "cost": total_cost})
+
+        if cursor.rowcount == 0: # Konto existiert (Vorprüfung), also reicht das Bargeld nicht
+            return jsonify({"error": "Nicht genügend Bargeld."}), 400
     
     db.commit() # Speichern
+    _portfolio_cache_invalidate(user_id)
     return jsonify({"message": "Kauf erfolgreich!"}), 201
 
 
 @app.route("/sell", methods=['POST'])
 def sell_stock():
-    data = request.get_json()
-    user_id = data['user_id']
-    ticker = data['ticker'].strip().upper()
-    quantity_to_sell = float(data['quantity'])
+    trade = _parse_trade(request.get_json(silent=True))
+    if trade is None: return jsonify({"error": "Ungültige Anfrage."}), 400
+    user_id, ticker, quantity_to_sell = trade
     if quantity_to_sell <= 0: return jsonify({"error": "Anzahl > 0"}), 400
     
+    # Kurs schon abrufen, während die Datenbank den Bestand prüft. Kompromiss: auch ein Verkauf
+    # ohne Bestand kann so einen Kursabruf bei Yahoo auslösen; nur bekannt ungültige Ticker
+    # werden gar nicht erst abgefragt.
+    if _cache_get(_UNKNOWN_TICKERS, ticker, UNKNOWN_TICKER_TTL):
+        price_future = None
+    else:
+        price_future = _EXECUTOR.submit(get_ticker_info, ticker)
+
     db = get_db()
     with db.cursor(cursor_factory=RealDictCursor) as cursor:
-        cursor.execute("SELECT * FROM positions WHERE user_id = %s AND ticker_symbol = %s", (user_id, ticker))
+        # Günstige Vorprüfung: ungültige Verkäufe scheitern, ohne auf den Kurs zu warten
+        _execute_prepared(cursor, "position_quantity",
+                          "SELECT quantity FROM positions WHERE user_id = %(user_id)s AND ticker_symbol = %(ticker)s",
+                          {"user_id": user_id, "ticker": ticker})
         position = cursor.fetchone()
         
         if position is None or position['quantity'] < quantity_to_sell: 
+            if price_future is not None:
+                price_future.cancel() # Noch wartende Abrufe nicht in _EXECUTOR liegen lassen
             return jsonify({"error": "Nicht genügend Stücke."}), 400
         
-        ticker_data = get_ticker_info(ticker) 
+        try:
+            ticker_data = price_future.result(timeout=PRICE_TIMEOUT) if price_future is not None else None
+        except FutureTimeoutError:
+            # Abruf aus der Warteschlange nehmen, sonst staut sich bei langsamem Yahoo ein Rückstau auf
+            price_future.cancel()
+            return jsonify({"error": f"Kurs für Ticker {ticker} derzeit nicht abrufbar."}), 503
         if ticker_data is None:
             return jsonify({"error": f"Kurs für Ticker {ticker} nicht gefunden."}), 404
         price = ticker_data['price']
 
         total_revenue = price * quantity_to_sell
         
-        cursor.execute("SELECT cash_balance FROM accounts WHERE user_id = %s", (user_id,))
-        account = cursor.fetchone()
-        
-        new_cash_balance = account['cash_balance'] + total_revenue
-        cursor.execute("UPDATE accounts SET cash_balance = %s WHERE user_id = %s", (new_cash_balance, user_id))
-        
-        new_quantity = position['quantity'] - quantity_to_sell
-        if new_quantity <= 0.0000001: # Toleranz für Fließkommazahlen
-            cursor.execute("DELETE FROM positions WHERE position_id = %s", (position['position_id'],))
-        else:
-            cursor.execute("UPDATE positions SET quantity = %s WHERE position_id = %s", (new_quantity, position['position_id']))
-        
-        cursor.execute("INSERT INTO transactions (user_id, ticker_symbol, transaction_type, quantity, price_per_share) VALUES (%s, %s, 'SELL', %s, %s)", 
-                       (user_id, ticker, quantity_to_sell, price))
+        # Position reduzieren bzw. schließen, Bargeld gutschreiben und Transaktion loggen in einem Round-Trip.
+        # closed/reduced schließen sich über die Restmenge gegenseitig aus (Toleranz für Fließkommazahlen).
+        _execute_prepared(cursor, "sell_book", """
+            WITH closed AS (
+                DELETE FROM positions
+                WHERE user_id = %(user_id)s AND ticker_symbol = %(ticker)s
+                  AND quantity >= %(quantity)s AND quantity - %(quantity)s <= 0.0000001
+                RETURNING user_id
+            ), reduced AS (
+                UPDATE positions SET quantity = quantity - %(quantity)s
+                WHERE user_id = %(user_id)s AND ticker_symbol = %(ticker)s
+                  AND quantity >= %(quantity)s AND quantity - %(quantity)s > 0.0000001
+                RETURNING user_id
+            ), credited AS (
+                UPDATE accounts SET cash_balance = cash_balance + %(revenue)s
+                WHERE user_id IN (SELECT user_id FROM closed UNION ALL SELECT user_id FROM reduced)
+                RETURNING user_id
+            )
+            INSERT INTO transactions (user_id, ticker_symbol, transaction_type, quantity, price_per_share)
+            SELECT user_id, %(ticker)s::text, 'SELL', %(quantity)s::numeric, %(price)s::numeric FROM credited
+        """, {"user_id": user_id, "ticker": ticker, "quantity": quantity_to_sell, "price": price, "revenue": total_revenue})
+
+        if cursor.rowcount == 0: # Bestand hat sich seit der Prüfung verändert
+            return jsonify({"error": "Nicht genügend Stücke."}), 400
     
     db.commit() # Speichern
+    _portfolio_cache_invalidate(user_id)
     return jsonify({"message": "Verkauf erfolgreich!"}), 200
 
 @app.route("/portfolio/<user_id>", methods=['GET'])
 def get_portfolio(user_id):
+    portfolio = _portfolio_cache_get(user_id)
+    if portfolio is None:
+        portfolio = _build_portfolio(user_id)
+        if portfolio is None: return jsonify({"error": f"Nutzer {user_id} nicht gefunden."}), 404
+        _portfolio_cache_set(user_id, portfolio)
+
+    response = jsonify(portfolio)
+    # ETag aus dem Inhalt: unveränderte Portfolios gehen als 304 ohne Body raus.
+    # no-cache statt max-age, damit der Browser nach einem Kauf nie ein altes Portfolio zeigt.
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.add_etag()
+    return response.make_conditional(request)
+
+def _build_portfolio(user_id):
+    """
+    Berechnet das Portfolio eines Nutzers mit aktuellen Kursen.
+    Gibt None zurück, wenn der Nutzer nicht existiert.
+    """
     db = get_db()
     with db.cursor(cursor_factory=RealDictCursor) as cursor:
-        cursor.execute("SELECT cash_balance FROM accounts WHERE user_id = %s", (user_id,))
-        account = cursor.fetchone()
-        if account is None: return jsonify({"error": f"Nutzer {user_id} nicht gefunden."}), 404
-            
-        cash_balance = account['cash_balance']
-        
-        cursor.execute("SELECT ticker_symbol, quantity, average_buy_price FROM positions WHERE user_id = %s", (user_id,))
-        positions = cursor.fetchall()
+        # Konto, Positionen und gespeicherte Kurse in einem Round-Trip;
+        # ohne Positionen liefert der LEFT JOIN eine Zeile mit NULLs.
+        # Einstandswerte (pro Position und gesamt) rechnet Postgres gleich mit.
+        _execute_prepared(cursor, "portfolio", """
+            SELECT a.cash_balance, p.ticker_symbol, p.quantity, p.average_buy_price,
+                   p.quantity * p.average_buy_price AS cost,
+                   COALESCE(SUM(p.quantity * p.average_buy_price) OVER (), 0) AS total_cost,
+                   p.ticker_symbol LIKE %(crypto_pattern)s AS is_crypto,
+                   tp.price AS stored_price, tp.change_pct AS stored_change_pct, tp.name AS stored_name,
+                   tp.updated_at >= NOW() - make_interval(secs => %(fresh_secs)s) AS stored_fresh
+            FROM accounts a
+            LEFT JOIN positions p ON p.user_id = a.user_id
+            LEFT JOIN ticker_prices tp ON tp.symbol = p.ticker_symbol
+            WHERE a.user_id = %(user_id)s
+        """, {"crypto_pattern": '%' + CRYPTO_SUFFIX, "fresh_secs": QUOTE_TTL, "user_id": user_id})
+        rows = cursor.fetchall()
+    # Verbindung nicht über den Kursabruf halten, sonst leert langsames Yahoo den Pool
+    _release_db()
+    if not rows: return None
+
+    cash_balance = rows[0]['cash_balance']
+    total_investment_cost = rows[0]['total_cost']
+    positions = [row for row in rows if row['ticker_symbol'] is not None]
     
+    # Nur Ticker ohne frischen Kurs in ticker_prices bei Yahoo abfragen, alle mit einem Sammelabruf
+    quotes = _fetch_quotes([pos['ticker_symbol'] for pos in positions if not pos['stored_fresh']])
+
     total_value_stocks = 0
     total_value_crypto = 0
-    total_investment_cost = 0 
     detailed_positions = []
 
     for pos in positions:
         ticker = pos['ticker_symbol']
         quantity = pos['quantity']
         avg_buy_price = pos['average_buy_price']
+        position_investment_cost = pos['cost']
         
-        position_investment_cost = avg_buy_price * quantity 
-        total_investment_cost += position_investment_cost  
-        
-        ticker_data = get_ticker_info(ticker) 
+        ticker_data = None if pos['stored_fresh'] else quotes.get(ticker) 
+        if ticker_data is None and pos['stored_price'] is not None:
+            # Frischer Kurs aus der Datenbank, oder der letzte bekannte, falls Yahoo nicht antwortet
+            ticker_data = {"price": pos['stored_price'], "change_pct": pos['stored_change_pct'] or 0,
+                           "name": pos['stored_name'] or ticker}
         current_price = 0
         day_change_pct = 0 
         name = ticker 
@@ -205,13 +944,13 @@ def get_portfolio(user_id):
              name = ticker_data['name'] 
         
         position_value = current_price * quantity
-        unrealized_pnl = (current_price - avg_buy_price) * quantity
+        unrealized_pnl = position_value - position_investment_cost
         
         unrealized_pnl_pct = 0
         if position_investment_cost > 0: 
             unrealized_pnl_pct = unrealized_pnl / position_investment_cost 
         
-        if ticker.endswith('-USD'):
+        if pos['is_crypto']:
             total_value_crypto += position_value
         else:
             total_value_stocks += position_value
@@ -236,7 +975,7 @@ def get_portfolio(user_id):
         overall_pnl = total_asset_value - total_investment_cost
         overall_pnl_pct = overall_pnl / total_investment_cost
 
-    return jsonify({
+    return {
         "user_id": user_id,
         "cash_balance": cash_balance,
         "total_asset_value": total_asset_value,
@@ -245,14 +984,20 @@ def get_portfolio(user_id):
         "total_portfolio_value": total_portfolio_value,
         "overall_pnl_pct": overall_pnl_pct, 
         "positions": detailed_positions
-    }), 200
+    }
 
 @app.route("/search/<query>")
 def search_ticker(query):
-    url = f"https://query1.finance.yahoo.com/v1/finance/search?q={query}&lang=en-US&region=US&quotesCount=8&newsCount=0"
-    headers = {'User-Agent': 'Mozilla/5.0'} 
+    query = query.strip().lower() # Normalisiert, damit "AAPL" und "aapl " denselben Cache-Eintrag nutzen
+    cache_key = ('search', query)
+    results = _cache_get(_RESPONSE_CACHE, cache_key, SEARCH_TTL)
+    if results is not None:
+        return _public_cached(jsonify(results), SEARCH_TTL)
+
+    url = "https://query1.finance.yahoo.com/v1/finance/search"
+    params = {"q": query, "lang": "en-US", "region": "US", "quotesCount": 8, "newsCount": 0}
     try:
-        response = requests.get(url, headers=headers)
+        response = _SESSION.get(url, params=params, timeout=HTTP_TIMEOUT)
         response.raise_for_status()
         data = response.json()
         results = []
@@ -265,35 +1010,41 @@ def search_ticker(query):
                     results.append({"symbol": quote['symbol'], "name": name})
                 elif quote.get('quoteType') == 'CRYPTOCURRENCY':
                      results.append({"symbol": quote['symbol'], "name": name})
-        return jsonify(results)
+        _cache_set(_RESPONSE_CACHE, cache_key, results)
+        return _public_cached(jsonify(results), SEARCH_TTL)
     except Exception as e:
-        print(f"Fehler bei der Ticker-Suche: {e}")
+        logger.warning("Fehler bei der Ticker-Suche: %s", e)
         return jsonify({"error": "Suche fehlgeschlagen"}), 500
 
 @app.route("/market_data")
 def get_market_data():
-    market_tickers = {
-        "DAX": "^GDAXI",
-        "Nasdaq": "^IXIC",
-        "Dow Jones": "^DJI",
-        "Nikkei": "^N225",
-        "S&P 500": "^GSPC",
-        "Gold": "GC=F",
-        "Bitcoin": "BTC-USD"
-    }
-    
-    results = {}
-    for name, ticker in market_tickers.items():
-        data = get_ticker_info(ticker)
-        if data:
-            results[name] = {
-                "price": data['price'],
-                "change_pct": data['change_pct']
-            }
-        else:
-            results[name] = {"price": "N/A", "change_pct": 0} 
-            
-    return jsonify(results)
+    # Die Marktdaten gelten je MARKET_DATA_TTL-Zeitfenster als unverändert: kennt der Client
+    # das Fenster schon, gibt es ein 304 ohne Cache- oder Yahoo-Zugriff
+    etag = f"market-{int(time.time() // MARKET_DATA_TTL)}"
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag, weak=True)
+        return _public_cached(response, MARKET_DATA_TTL)
+
+    results = _cache_get(_RESPONSE_CACHE, ('market_data', None), MARKET_DATA_TTL)
+    if results is None:
+        quotes = _fetch_quotes([ticker for _, ticker in MARKET_TICKERS]) # Ein Sammelabruf statt 7 Einzelabrufe
+
+        results = {}
+        for name, ticker in MARKET_TICKERS:
+            data = quotes.get(ticker)
+            if data:
+                results[name] = {
+                    "price": data['price'],
+                    "change_pct": data['change_pct']
+                }
+            else:
+                results[name] = {"price": "N/A", "change_pct": 0} 
+        _cache_set(_RESPONSE_CACHE, ('market_data', None), results)
+
+    response = jsonify(results)
+    response.set_etag(etag, weak=True)
+    return _public_cached(response, MARKET_DATA_TTL)
 
 # ===================================================================
 # ===== NEUER BEREICH: Historien-Endpunkte =====
@@ -308,54 +1059,85 @@ def record_portfolio_history():
     # 1. Sicherer Endpunkt
     auth_header = request.headers.get('Authorization')
     if not CRON_SECRET or auth_header != f"Bearer {CRON_SECRET}":
-        print("Cron Job Fehler: Nicht autorisierter Zugriff.")
+        logger.warning("Cron Job Fehler: Nicht autorisierter Zugriff.")
         return jsonify({"error": "Nicht autorisiert"}), 401
     
-    print("Cron Job: Starte Aufzeichnung des Portfolio-Verlaufs...")
+    logger.info("Cron Job: Starte Aufzeichnung des Portfolio-Verlaufs...")
     db = get_db()
     with db.cursor(cursor_factory=RealDictCursor) as cursor:
         
-        # 2. Hole alle User-IDs
-        cursor.execute("SELECT DISTINCT user_id FROM accounts")
-        users = cursor.fetchall()
-        
-        count = 0
-        for user in users:
-            user_id = user['user_id']
-            
+        # 2. Konten und Positionen aller Nutzer in einer einzigen Abfrage
+        cursor.execute("""
+            SELECT a.user_id, a.cash_balance, p.ticker_symbol, p.quantity
+            FROM accounts a
+            LEFT JOIN positions p ON p.user_id = a.user_id
+        """)
+        rows = cursor.fetchall()
+
+        users = {} # user_id -> {"cash_balance": ..., "positions": [...]}
+        for row in rows:
+            user = users.setdefault(row['user_id'], {"cash_balance": row['cash_balance'] or 0, "positions": []})
+            if row['ticker_symbol'] is not None: # Nutzer ohne Positionen liefern eine Zeile mit NULLs
+                user['positions'].append(row)
+
+        # 3. Alle gehaltenen Ticker einmalig und gebündelt bewerten (statt pro Nutzer und Position)
+        symbols = list({row['ticker_symbol'] for row in rows if row['ticker_symbol'] is not None})
+        price_map = {}
+        valid_quotes = {}
+        for symbol, ticker_data in _fetch_quotes(symbols, max_age=HISTORY_QUOTE_MAX_AGE).items():
+            # WICHTIG: Prüfen ob ticker_data und price existieren und numerisch sind
+            if ticker_data and isinstance(ticker_data.get('price'), (int, float)):
+                price_map[symbol] = ticker_data['price']
+                valid_quotes[symbol] = ticker_data
+            else:
+                logger.warning("Konnte Preis für %s nicht abrufen oder Preis ist ungültig.", symbol)
+
+        if symbols and not price_map:
+            # Yahoo komplett nicht erreichbar: lieber einen Punkt auslassen als nur das Bargeld
+            # als Portfoliowert zu speichern (das gäbe einen Einbruch im Chart)
+            logger.error("Cron Job Fehler: Keine Kurse verfügbar, es wird nichts gespeichert.")
+            return jsonify({"error": "Keine Kurse verfügbar"}), 503
+
+        _store_ticker_prices(cursor, valid_quotes)
+
+        history_rows = []
+        for user_id, user in users.items():
+            if not user['positions'] and not user['cash_balance']:
+                continue # Leeres Konto: kein sinnvoller Datenpunkt
+
             try:
-                # 3. Berechne den Gesamtwert
-                cursor.execute("SELECT cash_balance FROM accounts WHERE user_id = %s", (user_id,))
-                account = cursor.fetchone()
-                cash_balance = account['cash_balance'] if account else 0
-                
-                cursor.execute("SELECT ticker_symbol, quantity FROM positions WHERE user_id = %s", (user_id,))
-                positions = cursor.fetchall()
-                
+                # 4. Berechne den Gesamtwert
                 total_asset_value = 0
-                for pos in positions:
-                    ticker_data = get_ticker_info(pos['ticker_symbol'])
-                    # WICHTIG: Prüfen ob ticker_data und price existieren und numerisch sind
-                    if ticker_data and isinstance(ticker_data.get('price'), (int, float)):
-                        total_asset_value += ticker_data['price'] * pos['quantity']
-                    else:
-                        print(f"Warnung: Konnte Preis für {pos['ticker_symbol']} nicht abrufen oder Preis ist ungültig.")
-
-                total_portfolio_value = cash_balance + total_asset_value
-                
-                # 4. Speichere den Wert
-                cursor.execute(
-                    "INSERT INTO portfolio_history (user_id, value) VALUES (%s, %s)",
-                    (user_id, total_portfolio_value) # Sicherstellen, dass 'value' eine Zahl ist
-                )
-                count += 1
+                for pos in user['positions']:
+                    price = price_map.get(pos['ticker_symbol'])
+                    if price is not None:
+                        total_asset_value += price * pos['quantity']
+
+                total_portfolio_value = user['cash_balance'] + total_asset_value
+                history_rows.append((user_id, total_portfolio_value)) # Sicherstellen, dass 'value' eine Zahl ist
                 
             except Exception as e:
-                print(f"Fehler bei Aufzeichnung für User {user_id}: {e}")
+                logger.error("Fehler bei Aufzeichnung für User %s: %s", user_id, e)
         
+        # 5. Alle Werte mit einem mehrzeiligen INSERT speichern statt einem INSERT pro Nutzer
+        execute_values(cursor, "INSERT INTO portfolio_history (user_id, value) VALUES %s",
+                       history_rows, page_size=500)
+        count = len(history_rows)
+
+        # 6. Tagesdurchschnitt des aktuellen UTC-Tages fortschreiben (Grundlage für den 1y-Chart)
+        cursor.execute("""
+            INSERT INTO portfolio_history_daily (user_id, day, value)
+            SELECT user_id, (created_at AT TIME ZONE 'UTC')::date, AVG(value)::float8
+            FROM portfolio_history
+            WHERE created_at >= date_trunc('day', NOW() AT TIME ZONE 'UTC')
+            GROUP BY 1, 2
+            ON CONFLICT (user_id, day) DO UPDATE SET value = EXCLUDED.value
+        """)
+
         db.commit() 
     
-    print(f"Cron Job: {count} Portfolio-Werte erfolgreich gespeichert.")
+    _history_cache_clear() # Neue Datenpunkte sollen sofort im Chart erscheinen
+    logger.info("Cron Job: %s Portfolio-Werte erfolgreich gespeichert.", count)
     return jsonify({"message": f"{count} Portfolio-Werte erfolgreich gespeichert."}), 200
 
 
@@ -365,6 +1147,10 @@ def get_portfolio_history(user_id):
     Wird vom Frontend (Netlify) aufgerufen, liest gespeicherte Daten.
     """
     range = request.args.get('range', '1d').lower()
+
+    history_data = _history_cache_get(user_id, range)
+    if history_data is not None:
+        return jsonify(history_data), 200
     
     db = get_db()
     with db.cursor(cursor_factory=RealDictCursor) as cursor:
@@ -374,7 +1160,7 @@ def get_portfolio_history(user_id):
         if range == '1d':
             # Zeigt den *aktuellen Tag* von 00:00 Uhr bis jetzt
             sql = """
-                SELECT created_at as timestamp, value
+                SELECT to_char(created_at AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS"Z"') as timestamp, value::float8 as value
                 FROM portfolio_history
                 WHERE user_id = %s AND created_at >= date_trunc('day', NOW() AT TIME ZONE 'UTC') -- UTC verwenden für Konsistenz
                 ORDER BY created_at ASC;
@@ -385,7 +1171,7 @@ def get_portfolio_history(user_id):
             interval = '7 days'
             # Zeigt die *letzten 7 Tage* (rollierend)
             sql = """
-                SELECT created_at as timestamp, value
+                SELECT to_char(created_at AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS"Z"') as timestamp, value::float8 as value
                 FROM portfolio_history
                 WHERE user_id = %s AND created_at >= NOW() AT TIME ZONE 'UTC' - INTERVAL %s
                 ORDER BY created_at ASC;
@@ -396,7 +1182,7 @@ def get_portfolio_history(user_id):
             interval = '1 month'
             # Zeigt den *letzten Monat* (rollierend)
             sql = """
-                SELECT created_at as timestamp, value
+                SELECT to_char(created_at AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS"Z"') as timestamp, value::float8 as value
                 FROM portfolio_history
                 WHERE user_id = %s AND created_at >= NOW() AT TIME ZONE 'UTC' - INTERVAL %s
                 ORDER BY created_at ASC;
@@ -405,22 +1191,19 @@ def get_portfolio_history(user_id):
 
         elif range == '1y':
             interval = '1 year'
-            # Bündelt die Daten auf einen Wert pro Tag (Durchschnitt)
+            # Ein Wert pro Tag (Durchschnitt), vom Cron Job in portfolio_history_daily vorberechnet
             sql = """
-                SELECT 
-                  date_trunc('day', created_at AT TIME ZONE 'UTC') as timestamp, -- Bündelt auf den UTC-Tag
-                  AVG(value) as value
-                FROM portfolio_history
-                WHERE user_id = %s AND created_at >= NOW() AT TIME ZONE 'UTC' - INTERVAL %s
-                GROUP BY 1 
-                ORDER BY 1 ASC;
+                SELECT to_char(day, 'YYYY-MM-DD"T"HH24:MI:SS"Z"') as timestamp, value
+                FROM portfolio_history_daily
+                WHERE user_id = %s AND day >= (NOW() AT TIME ZONE 'UTC' - INTERVAL %s)::date
+                ORDER BY day ASC;
             """
             params = (user_id, interval)
             
         else: # Fallback
              # Standardmäßig den aktuellen Tag zeigen
             sql = """
-                SELECT created_at as timestamp, value
+                SELECT to_char(created_at AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS"Z"') as timestamp, value::float8 as value
                 FROM portfolio_history
                 WHERE user_id = %s AND created_at >= date_trunc('day', NOW() AT TIME ZONE 'UTC')
                 ORDER BY created_at ASC;
@@ -428,17 +1211,11 @@ def get_portfolio_history(user_id):
             params = (user_id,)
 
         # 2. Führe die Abfrage aus
+        # WICHTIG: value (float8) und timestamp (ISO 8601 in UTC) kommen schon JSON-fertig aus der Datenbank
         cursor.execute(sql, params)
         history_data = cursor.fetchall()
-        
-        # WICHTIG: Konvertiere Decimal zu float für JSON
-        for row in history_data:
-            if 'value' in row and row['value'] is not None:
-                row['value'] = float(row['value'])
-            # Konvertiere datetime zu ISO 8601 String (Standard für JSON)
-            if 'timestamp' in row and row['timestamp'] is not None:
-                 row['timestamp'] = row['timestamp'].isoformat()
 
+        _history_cache_set(user_id, range, history_data)
 
         # 3. Sende die Daten als JSON
         return jsonify(history_data), 200
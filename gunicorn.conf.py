@@ -0,0 +1,18 @@
+# Gunicorn-Konfiguration für Render (Start: gunicorn app:app)
+# gevent-Worker: Während ein Request auf Yahoo oder die Datenbank wartet,
+# bedient derselbe Worker weitere Requests.
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+# Patcht die Python-Sockets (requests, redis) beim Worker-Start automatisch. yfinance (curl_cffi)
+# läuft in C und wird davon nicht erfasst; app.py führt es deshalb auf echten OS-Threads aus (_YF_POOL).
+worker_class = "gevent"
+workers = int(os.environ.get('WEB_CONCURRENCY', 4))
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 1000)) # Gleichzeitige Requests pro Worker
+
+
+def post_fork(server, worker):
+    # psycopg2 spricht libpq direkt an und wird vom gevent-Patch nicht erfasst.
+    # psycogreen sorgt dafür, dass auch Datenbank-Wartezeiten an andere Requests abgegeben werden.
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
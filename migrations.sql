@@ -0,0 +1,55 @@
+-- Schema-Anpassungen für die Supabase-Datenbank.
+-- Einmalig im SQL-Editor ausführen; alle Statements sind wiederholbar.
+-- Danach migrations_index.sql separat ausführen: CREATE INDEX CONCURRENTLY darf nicht
+-- im selben Skript laufen, da der SQL-Editor ein Skript als eine Transaktion ausführt.
+
+-- Eine Position pro Nutzer und Ticker. Voraussetzung für INSERT ... ON CONFLICT in /buy.
+-- Zuerst doppelte Positionen (aus dem früheren SELECT-dann-INSERT) zusammenführen,
+-- sonst schlägt das Anlegen des Constraints fehl. Durchschnittskurs mengengewichtet.
+WITH merged AS (
+    SELECT user_id, ticker_symbol, MIN(position_id) AS keep_id,
+           SUM(quantity) AS quantity,
+           SUM(quantity * average_buy_price) / NULLIF(SUM(quantity), 0) AS average_buy_price
+    FROM positions
+    GROUP BY user_id, ticker_symbol
+    HAVING COUNT(*) > 1
+), kept AS (
+    UPDATE positions p
+    SET quantity = m.quantity, average_buy_price = COALESCE(m.average_buy_price, p.average_buy_price)
+    FROM merged m
+    WHERE p.position_id = m.keep_id
+)
+DELETE FROM positions p
+USING merged m
+WHERE p.user_id = m.user_id AND p.ticker_symbol = m.ticker_symbol AND p.position_id <> m.keep_id;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'uq_positions_user_ticker') THEN
+        ALTER TABLE positions ADD CONSTRAINT uq_positions_user_ticker UNIQUE (user_id, ticker_symbol);
+    END IF;
+END $$;
+
+-- Zuletzt abgerufener Kurs je Ticker; wird vom Cron Job (und optional vom Refresh-Thread) gepflegt.
+-- /portfolio liest frische Kurse von hier statt bei Yahoo.
+CREATE TABLE IF NOT EXISTS ticker_prices (
+    symbol      TEXT PRIMARY KEY,
+    price       DOUBLE PRECISION NOT NULL,
+    change_pct  DOUBLE PRECISION,
+    name        TEXT,
+    updated_at  TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- Tagesdurchschnitte je Nutzer (UTC-Tag) für den 1y-Chart. Wird beim Anlegen aus dem
+-- bisherigen Verlauf befüllt und danach vom Cron Job für den laufenden Tag fortgeschrieben.
+CREATE TABLE IF NOT EXISTS portfolio_history_daily AS
+    SELECT user_id, (created_at AT TIME ZONE 'UTC')::date AS day, AVG(value)::float8 AS value
+    FROM portfolio_history
+    GROUP BY 1, 2;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'portfolio_history_daily_pkey') THEN
+        ALTER TABLE portfolio_history_daily ADD CONSTRAINT portfolio_history_daily_pkey PRIMARY KEY (user_id, day);
+    END IF;
+END $$;
@@ -0,0 +1,11 @@
+-- Index-Migration für die Supabase-Datenbank, nach migrations.sql ausführen.
+-- Als eigenes Skript im SQL-Editor ausführen (nicht zusammen mit anderen Statements);
+-- wiederholbar. Bricht das Anlegen ab, den ungültigen Index mit DROP INDEX entfernen
+-- und das Skript erneut ausführen.
+
+-- Index für die Verlaufsabfragen (Filter auf user_id, Bereich auf created_at).
+-- INCLUDE (value) erlaubt Index-Only-Scans. CONCURRENTLY sperrt die Tabelle nicht,
+-- darf aber nicht in einer Transaktion laufen.
+-- positions(user_id, ticker_symbol) ist bereits durch uq_positions_user_ticker indiziert.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_portfolio_history_user_time
+    ON portfolio_history (user_id, created_at DESC) INCLUDE (value);